@@ -0,0 +1,965 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+waa.py 的回歸檢查（固定種子、可重現；只用標準函式庫的 unittest）。
+
+- 查表引擎：10^6 格結果表逐格對照直接依規則發牌的參考實作。
+- 向量化掃描：natural_spans_from_points（numpy 與逐起點查表）結果相同，含多靴一次掃描與不足一局的短序列。
+- 多行程生成：不論行程數，同一整體種子產出的靴（含各靴種子與通過的嘗試序）完全相同。
+- 花色規則預檢：check_rules_feasibility 淘汰的打包，貪婪流程與求解器也必定淘汰。
+- 尾局查表：7722 種尾局點數組合逐一以窮舉排列驗證。
+- 建構式補強：refill_from_patterns 取出的局互不重疊、皆為敏感局，停下時剩牌可收尾；樣式機率加總等於敏感密度。
+- 切牌模擬：simulate_cut_matrix（numpy 與純 Python）與逐靴 simulate_cut_positions、逐切點直接計數一致。
+- 串流輸出：中斷（含寫了一半的資料）後續跑，輸出與一次跑完相同；檢查點大小不隨靴數成長。
+- 封存檔：寫入 / 殘筆截斷後續寫 / 讀回一致；由欄位直接算出的切牌矩陣與逐靴計算相同。
+- 牌靴庫存：依規則設定分庫、依屬性篩選、先進先出取用並移除；generate_shoes 先取庫存再現場生成。
+- 生成 API：generate_shoes 依 num_shoes / first_shoe / target_count / time_budget 停止，且不動 random 的全域狀態。
+- 遙測：每次嘗試恰記為一次淘汰或一次通過（含預檢、重綁花色、局部修補與貪婪流程），merge 後仍成立。
+- 重播與重建：regenerate_shoe 依嘗試序（或從頭）重建出同一副靴；遙測樣本重播得到相同的淘汰原因。
+- 牌靴服務：/health、/metrics、/shoe（含 HEAD）、404 / 400 / 405 的狀態列、LRU 移除池、失敗池停用回 503、先取庫存。
+- 敏感密度：小牌池的 sensitivity_density 對照完整排列枚舉（含無 numpy 的純 Python 路徑）；牌太少時為 0；期望重洗次數超過上限時提早放棄。
+- 局部修補：repair_near_miss 的結果為完整、不重疊且每局皆敏感的分割，只拆最後幾局且不改動傳入的局；同一 rng 種子修補結果相同。
+- 母體統計：PopulationStats 分段 merge（含封存檔分範圍、多行程）與一次累計相同，並與逐靴切牌模擬一致。
+- 切牌重發：redeal_cut_matrix（向量化與純 Python）對照 redeal_shoe；切點 0 重現原靴；靴長不一拋出 ValueError。
+- 花色求解：solve_suit_rules 的結果須符合和局 / 訊號 / 平衡規則且牌面不變；貪婪流程能通過的，求解器必定通過。
+
+使用方式：
+- python test_waa.py         （或 python -m pytest -q test_waa.py）
+"""
+from __future__ import annotations
+from typing import List, Optional, Tuple
+from unittest import mock
+import asyncio, collections, contextlib, csv, gzip, io, itertools, json, os, random, tempfile, time, unittest, urllib.parse
+
+import waa
+import waa_server
+
+TEST_SEED = 20240601
+TEST_SHOES = 4
+
+# =========================
+# 共用資料
+# =========================
+
+_FIXTURE: dict = {}
+
+def setUpModule():
+    """以固定種子生成幾副合格靴（所有案例共用，只讀不改）。"""
+    params = waa.GenerationConfig(seed=TEST_SEED).params()
+    shoes, attempts = [], []
+    for idx in range(1, TEST_SHOES + 1):
+        _, shoe, error, telemetry = waa.generate_shoe_job(idx, waa.derive_seed(TEST_SEED, idx), params, True)
+        assert shoe is not None, error
+        shoes.append(shoe)
+        attempts.append(telemetry.accepted_attempt)
+    _FIXTURE.update(params=params, shoes=shoes, attempts=attempts)
+
+# =========================
+# 參考實作：直接依規則發一局（不經查表）
+# =========================
+
+# 閒家補第三張後，莊家（兩張合計）在閒家第三張為哪些點數時補牌
+_BANKER_TABLEAU = {0: set(range(10)), 1: set(range(10)), 2: set(range(10)), 3: set(range(10)) - {8},
+                   4: {2, 3, 4, 5, 6, 7}, 5: {4, 5, 6, 7}, 6: {6, 7}, 7: set()}
+
+def _reference_round(pts) -> Tuple[str, int, int, int]:
+    """依序發 閒、莊、閒、莊，再依補牌規則補牌；回傳 (結果, 使用張數, 莊點, 閒點)。pts 須有 6 張。"""
+    p_tot = (pts[0] + pts[2]) % 10
+    b_tot = (pts[1] + pts[3]) % 10
+    used = 4
+    if p_tot < 8 and b_tot < 8:
+        p3 = None
+        if p_tot <= 5:
+            p3 = pts[used]
+            used += 1
+            p_tot = (p_tot + p3) % 10
+        if (b_tot <= 5) if p3 is None else (p3 in _BANKER_TABLEAU[b_tot]):
+            b_tot = (b_tot + pts[used]) % 10
+            used += 1
+    result = '和' if p_tot == b_tot else ('閒' if p_tot > b_tot else '莊')
+    return result, used, b_tot, p_tot
+
+def _reference_sensitive(seq) -> bool:
+    """seq 恰為一局（張數相符）且 P1↔B1 互換後結果在閒 / 莊間翻轉、張數不變；排除 原=和 且 換後=莊。"""
+    pts = list(seq) + [0] * (waa.ROUND_WINDOW - len(seq))
+    res, used, _, _ = _reference_round(pts)
+    pts[0], pts[1] = pts[1], pts[0]
+    s_res, s_used, _, _ = _reference_round(pts)
+    return (used == len(seq) and s_used == used and s_res != res and s_res != '和'
+            and not (res == '和' and s_res == '莊'))
+
+# =========================
+# 查表引擎
+# =========================
+
+class OutcomeTableTest(unittest.TestCase):
+
+    def test_every_window_matches_reference_rules(self):
+        bad = []
+        for key, pts in enumerate(itertools.product(range(10), repeat=waa.ROUND_WINDOW)):
+            code = waa._OUTCOME_TABLE[key]
+            got = (waa.RESULT_CODES[code & 3], (code >> 2) & 7, (code >> 5) & 15, (code >> 9) & 15)
+            if got != _reference_round(pts):
+                bad.append(key)
+        self.assertEqual(bad[:10], [])
+
+    def test_simulator_round_matches_reference(self):
+        deck = waa.build_shuffled_deck(random.Random(TEST_SEED))
+        sim = waa.Simulator(deck)
+        for start in range(len(deck) - waa.ROUND_WINDOW):
+            r = sim.simulate_round(start)
+            pts = sim.points[start:start + waa.ROUND_WINDOW]
+            res, used, _, _ = _reference_round(pts)
+            self.assertEqual((r.result, len(r.cards)), (res, used))
+            self.assertEqual(r.sensitive, _reference_sensitive(pts[:used]))
+            self.assertEqual(sim.sensitivity_bitmap()[start], int(r.sensitive))
+
+    def test_short_window(self):
+        self.assertIsNone(waa.lookup_outcome([1, 2, 3]))
+
+# =========================
+# 向量化掃描
+# =========================
+
+@unittest.skipIf(waa.np is None, '需要 numpy')
+class VectorizedScanTest(unittest.TestCase):
+
+    def test_matches_pure_python_scan(self):
+        rng = random.Random(TEST_SEED)
+        decks = [[c.point() for c in waa.build_shuffled_deck(rng)] for _ in range(20)]
+        for points in decks:
+            fast = waa.natural_spans_from_points(points, vectorized=True)
+            self.assertEqual(fast, waa.natural_spans_from_points(points, vectorized=False))
+            self.assertGreater(len(fast), 0)
+        # 多靴一次掃描：每列與單靴掃描相同
+        start, length, result, sensitive = waa.scan_sensitive_arrays(decks)
+        for k, points in enumerate(decks):
+            idx = waa.np.flatnonzero(sensitive[k])
+            rows = list(zip(start[k][idx].tolist(), length[k][idx].tolist(), result[k][idx].tolist()))
+            self.assertEqual(rows, waa.natural_spans_from_points(points, vectorized=False))
+
+    def test_short_sequences(self):
+        rng = random.Random(TEST_SEED)
+        for n in range(10):
+            points = [rng.randrange(10) for _ in range(n)]
+            self.assertEqual(waa.natural_spans_from_points(points, vectorized=True),
+                             waa.natural_spans_from_points(points, vectorized=False), points)
+
+    def test_simulator_spans(self):
+        sim = waa.Simulator(waa.build_shuffled_deck(random.Random(TEST_SEED)))
+        self.assertEqual(waa.natural_sensitive_spans(sim, vectorized=True),
+                         waa.natural_sensitive_spans(sim, vectorized=False))
+
+# =========================
+# 多行程生成
+# =========================
+
+def _shoe_key(shoe: waa.CompactShoe):
+    return shoe.shoe_index, bytes(shoe.codes), bytes(shoe.colors), bytes(shoe.spans), shoe.tail_len
+
+class WorkerCountTest(unittest.TestCase):
+
+    def _run(self, workers: int):
+        config = waa.GenerationConfig(seed=TEST_SEED, num_shoes=4, workers=workers)
+        return [(_shoe_key(g.shoe), g.seed, g.attempt) for g in waa.generate_shoes(config)]
+
+    def test_output_independent_of_worker_count(self):
+        serial = self._run(1)
+        self.assertEqual([key[0] for key, _, _ in serial], [1, 2, 3, 4])
+        self.assertEqual([seed for _, seed, _ in serial], [waa.derive_seed(TEST_SEED, i) for i in range(1, 5)])
+        self.assertEqual(self._run(2), serial)
+        self.assertEqual(self._run(3), serial)
+
+# =========================
+# 花色規則預檢
+# =========================
+
+class FeasibilityTest(unittest.TestCase):
+    """check_rules_feasibility 只在計數上證明必敗時才淘汰：它淘汰的，逐階段貪婪流程也必定淘汰。"""
+
+    CASES = [('♥', None), ('♥', '♣'), (None, '♣')]
+
+    def test_never_rejects_what_the_rules_accept(self):
+        rng = random.Random(TEST_SEED)
+        rejected = collections.Counter()
+        shoes = 0
+        while shoes < 60:
+            packed = waa.pack_all_sensitive_once(waa.build_shuffled_deck(rng), min_tail_stop=None,
+                                                 multi_pass_min_cards=None, rng=rng)
+            if not packed:
+                continue
+            shoes += 1
+            shoe = waa.CompactShoe.from_rounds(0, *packed)
+            for signal_suit, tie_suit in self.CASES:
+                sr = shoe.materialize()
+                reason = waa.check_rules_feasibility(waa.shoe_round_views(sr.rounds, sr.tail),
+                                                     signal_suit=signal_suit, tie_suit=tie_suit)
+                if reason is None:
+                    continue
+                rejected[reason] += 1
+                sr = shoe.materialize()
+                self.assertIsNotNone(waa.shoe_rules_rejection(
+                    sr.rounds, sr.tail, signal_suit=signal_suit, tie_suit=tie_suit, late_diff=2,
+                    suit_rule_solver=False, rng=random.Random(shoes)), reason)
+                sr = shoe.materialize()
+                self.assertIsNotNone(waa.solve_suit_rules(
+                    waa.shoe_round_views(sr.rounds, sr.tail), signal_suit=signal_suit, tie_suit=tie_suit,
+                    late_diff=2), reason)
+        self.assertGreater(sum(rejected.values()), 0)
+
+# =========================
+# 尾局查表
+# =========================
+
+class TailTableTest(unittest.TestCase):
+
+    def test_every_entry_against_brute_force(self):
+        table = waa._tail_table()
+        self.assertEqual(len(table), 7722)
+        for ms, order in table.items():
+            # 表中為字典序最小的敏感排列；逐一窮舉到第一個敏感排列即可判定
+            expected = next((p for p in sorted(set(itertools.permutations(ms))) if _reference_sensitive(p)), None)
+            self.assertEqual(order, expected, ms)
+
+    def test_tail_possible(self):
+        self.assertTrue(waa.tail_possible([]))
+        self.assertFalse(waa.tail_possible([1, 2, 3]))
+        self.assertFalse(waa.tail_possible([0] * 7))
+
+# =========================
+# 建構式補強
+# =========================
+
+@unittest.skipIf(waa.np is None, '需要 numpy')
+class ConstructiveRefillTest(unittest.TestCase):
+
+    def test_rounds_are_sensitive_and_disjoint(self):
+        rng = random.Random(TEST_SEED)
+        stop = waa.DENSITY_TAIL_STOP
+        finished = 0
+        for _ in range(20):
+            points = [c.point() for c in waa.build_shuffled_deck(rng)]
+            remaining = sorted(rng.sample(range(len(points)), 200))
+            rounds, tail = waa.refill_from_patterns(points, remaining, min_tail_stop=stop, multi_pass_min_cards=4,
+                                                    rng=rng)
+            self.assertEqual(sorted([p for r in rounds for p in r] + tail), remaining)
+            for r in rounds:
+                self.assertTrue(_reference_sensitive([points[p] for p in r]), r)
+            if len(tail) < stop:
+                # 只抽不會逼進死路的樣式：停在停止張數以下時，剩牌必可排成敏感尾局
+                self.assertTrue(waa.tail_possible([points[p] for p in tail]), tail)
+                finished += 1
+        self.assertGreater(finished, 0)
+
+    def test_same_rng_same_rounds(self):
+        points = [c.point() for c in waa.build_shuffled_deck(random.Random(TEST_SEED))]
+        runs = [waa.refill_from_patterns(points, list(range(len(points))), min_tail_stop=7, multi_pass_min_cards=4,
+                                         rng=random.Random(1)) for _ in range(2)]
+        self.assertIsNotNone(runs[0])
+        self.assertEqual(runs[0], runs[1])
+
+    def test_pattern_weights_sum_to_density(self):
+        # 各樣式「第一局恰為此樣式」的機率加總，即為第一局為敏感局的機率
+        for hist in [(1, 1, 1, 1, 1, 1, 1, 0, 0, 0), (3, 0, 1, 0, 1, 0, 1, 1, 0, 0), (5, 4, 3, 2, 1, 0, 2, 3, 4, 5),
+                     (32, 32, 32, 128, 32, 32, 32, 32, 32, 32)]:
+            total = float(waa._pattern_weights(waa.np.array(hist)).sum())
+            self.assertAlmostEqual(total, waa.sensitivity_density(hist).p_sensitive, places=12, msg=hist)
+
+# =========================
+# 切牌模擬
+# =========================
+
+def _naive_cut_rows(shoe: waa.CompactShoe) -> List[Tuple[int, int]]:
+    """逐切點直接數：結束位置不超過切點的局數與其中的敏感局數。"""
+    spans = shoe.round_spans()
+    rows = []
+    for cut_pos in range(1, len(shoe.codes) + 1):
+        done = [s for off, n, _, s in spans if off + n <= cut_pos]
+        rows.append((len(done), sum(1 for s in done if s)))
+    return rows
+
+class CutMatrixTest(unittest.TestCase):
+
+    def _check(self, shoes):
+        played, hits = waa.simulate_cut_matrix(shoes)
+        for i, sh in enumerate(shoes):
+            sr = sh.materialize()
+            rows = waa.simulate_cut_positions(sr.rounds, sr.tail)
+            self.assertEqual([(r[1], r[2]) for r in rows], _naive_cut_rows(sh))
+            self.assertEqual([int(x) for x in played[i]], [r[1] for r in rows])
+            self.assertEqual([int(x) for x in hits[i]], [r[2] for r in rows])
+
+    def test_matrix_matches_per_shoe_simulation(self):
+        self._check(_FIXTURE['shoes'])
+
+    def test_pure_python_path(self):
+        with mock.patch.object(waa, 'np', None):
+            self._check(_FIXTURE['shoes'])
+
+    def test_empty_and_unequal(self):
+        self.assertEqual(waa.simulate_cut_matrix([]), ([], []))
+        sh = _FIXTURE['shoes'][0]
+        short = waa.CompactShoe(0, bytes(sh.codes[:-4]), b'', b'', 0)
+        with self.assertRaises(ValueError):
+            waa.simulate_cut_matrix([sh, short])
+
+# =========================
+# 串流輸出續跑
+# =========================
+
+class StreamingResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.addCleanup(os.chdir, self.cwd)
+        self.results = [waa.generated_shoe(sh, None) for sh in _FIXTURE['shoes']]
+        self.fingerprint = dict(seed=TEST_SEED, shoes=len(self.results))
+
+    def _run(self, use_gzip: bool, crash_after: Optional[int]) -> Tuple[List[bytes], List[int]]:
+        """在暫存目錄寫出全部靴；crash_after 指定時於該靴後中斷（另寫入半筆資料）再續跑。
+        回傳 (三個輸出檔解壓後的內容, 每靴之後的檢查點大小)。"""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.chdir(tmp.name)
+        ckpt = 'run.ckpt.json'
+        out = waa.StreamingCsvOutput.open(ckpt, TEST_SEED, self.fingerprint, use_gzip)
+        sizes = []
+        for g in self.results:
+            if crash_after is not None and g.shoe_index == crash_after + 1:
+                # 中斷：這一靴的資料只寫了一部分，檢查點未更新
+                out._append('rounds', waa.rounds_csv_rows(g.result), waa.ROUNDS_CSV_HEADER)
+                with open(out.files['cut'], 'ab') as f:
+                    f.write(b'\x1f\x8b\x08partial' if use_gzip else b'1,2,3,partial')
+                out = waa.StreamingCsvOutput.open(ckpt, TEST_SEED, self.fingerprint, use_gzip)
+                self.assertEqual(out.next_shoe, g.shoe_index)
+            out.append(g.result, g.cut)
+            sizes.append(os.path.getsize(ckpt))
+        files = dict(out.files)
+        out.finish()
+        self.assertFalse(os.path.exists(ckpt))
+        self.assertFalse(os.path.exists(files['summary']))
+        data = []
+        for key in ('rounds', 'vertical', 'cut'):
+            with open(files[key], 'rb') as f:
+                raw = f.read()
+            data.append(gzip.decompress(raw) if use_gzip else raw)
+        return data, sizes
+
+    def test_resume_matches_uninterrupted_run(self):
+        for use_gzip in (False, True):
+            full, sizes = self._run(use_gzip, None)
+            resumed, _ = self._run(use_gzip, 2)
+            self.assertEqual(full, resumed, use_gzip)
+            # 檢查點只記錄各檔長度與靴序，不隨靴數成長
+            self.assertLess(max(sizes) - min(sizes), 16)
+
+    def test_summary_block(self):
+        data, _ = self._run(False, None)
+        rows = list(csv.reader(io.StringIO(data[2].decode('utf-8-sig'))))
+        at = rows.index(waa.CUT_SUMMARY_HEADER)
+        self.assertEqual([int(r[0]) for r in rows[at + 1:]], [g.shoe_index for g in self.results])
+
+# =========================
+# 封存檔
+# =========================
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'shoes.waa')
+        self.config = dict(seed=TEST_SEED, params=_FIXTURE['params'])
+
+    def test_round_trip_and_torn_record(self):
+        shoes = _FIXTURE['shoes']
+        with waa.ShoeArchiveWriter(self.path, self.config) as w:
+            for sh in shoes[:-1]:
+                w.append(sh)
+        # 模擬寫到一半中斷：結尾留下不完整的紀錄
+        with open(self.path, 'ab') as f:
+            f.write(waa._encode_archive_record(shoes[-1])[:waa.ARCHIVE_RECORD_SIZE // 2])
+        with waa.ShoeArchive(self.path) as ar:
+            self.assertEqual(len(ar), len(shoes) - 1)
+            self.assertEqual([_shoe_key(sh) for sh in ar], [_shoe_key(sh) for sh in shoes[:-1]])
+        with waa.ShoeArchiveWriter(self.path, self.config) as w:
+            self.assertEqual(w.count, len(shoes) - 1)
+            w.append(shoes[-1])
+        with waa.ShoeArchive(self.path) as ar:
+            self.assertEqual(ar.config, json.loads(json.dumps(self.config)))
+            self.assertEqual([_shoe_key(ar[i]) for i in range(len(ar))], [_shoe_key(sh) for sh in shoes])
+            self.assertEqual(_shoe_key(ar[-1]), _shoe_key(shoes[-1]))
+            if waa.np is not None:
+                cols = ar.columns()
+                for i, sh in enumerate(shoes):
+                    self.assertEqual(bytes(cols['codes'][i][:len(sh.codes)]), bytes(sh.codes))
+                del cols
+
+    def test_cut_matrix_from_columns(self):
+        shoes = _FIXTURE['shoes']
+        with waa.ShoeArchiveWriter(self.path, self.config) as w:
+            for sh in shoes:
+                w.append(sh)
+        expected = waa.simulate_cut_matrix(shoes)
+        with waa.ShoeArchive(self.path) as ar:
+            played, hits = waa.simulate_cut_matrix(ar)
+            self.assertEqual([list(map(int, row)) for row in played], [list(map(int, row)) for row in expected[0]])
+            self.assertEqual([list(map(int, row)) for row in hits], [list(map(int, row)) for row in expected[1]])
+            del played, hits
+
+    def test_config_mismatch(self):
+        with waa.ShoeArchiveWriter(self.path, self.config) as w:
+            w.append(_FIXTURE['shoes'][0])
+        with self.assertRaises(ValueError):
+            waa.ShoeArchiveWriter(self.path, dict(self.config, seed=TEST_SEED + 1))
+
+# =========================
+# 牌靴庫存
+# =========================
+
+class ShoeLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'library.sqlite')
+        self.rule_config = waa.library_rule_config(_FIXTURE['params'], True)
+
+    def test_take_with_filters(self):
+        shoes = _FIXTURE['shoes']
+        rounds = [waa.shoe_properties(sh)['n_rounds'] for sh in shoes]
+        lo = sorted(rounds)[len(rounds) // 2]
+        with waa.ShoeLibrary(self.path) as library:
+            key = library.register(self.rule_config)
+            self.assertEqual(library.configs(), {key: self.rule_config})
+            for i, sh in enumerate(shoes):
+                library.add(key, sh, i)
+            self.assertEqual(library.stock(key), len(shoes))
+            self.assertEqual(library.stock('other'), 0)
+            matching = [sh for sh, n in zip(shoes, rounds) if n >= lo]
+            self.assertEqual(library.stock(key, n_rounds=(lo, None)), len(matching))
+            taken = library.take(key, 10, first_index=7, n_rounds=(lo, None))
+            # 先進先出，靴序重新編號
+            self.assertEqual([sh.shoe_index for sh in taken], list(range(7, 7 + len(matching))))
+            self.assertEqual([_shoe_key(sh)[1:] for sh in taken], [_shoe_key(sh)[1:] for sh in matching])
+            self.assertEqual(library.take(key, 10, n_rounds=(lo, None)), [])
+            self.assertEqual(library.stock(key), len(shoes) - len(matching))
+            with self.assertRaises(ValueError):
+                library.stock(key, colour=(0, 1))
+
+    def test_generate_shoes_serves_library_first(self):
+        with waa.ShoeLibrary(self.path) as library:
+            key = library.register(self.rule_config)
+            for sh in _FIXTURE['shoes'][:2]:
+                library.add(key, sh, 0)
+        config = waa.GenerationConfig(seed=TEST_SEED, num_shoes=3, library_path=self.path)
+        got = list(waa.generate_shoes(config))
+        self.assertEqual([g.shoe_index for g in got], [1, 2, 3])
+        self.assertEqual([g.seed for g in got], [None, None, waa.derive_seed(TEST_SEED, 3)])
+        self.assertEqual([_shoe_key(g.shoe)[1:] for g in got[:2]], [_shoe_key(sh)[1:] for sh in _FIXTURE['shoes'][:2]])
+        with waa.ShoeLibrary(self.path) as library:
+            self.assertEqual(library.stock(key), 0)
+
+    def test_fill_to_target(self):
+        added = waa.fill_shoe_library(self.path, _FIXTURE['params'], True, 2, log=lambda *_: None)
+        self.assertEqual(added, 2)
+        self.assertEqual(waa.fill_shoe_library(self.path, _FIXTURE['params'], True, 2, log=lambda *_: None), 0)
+        with waa.ShoeLibrary(self.path) as library:
+            self.assertEqual(library.stock(waa.library_config_key(self.rule_config)), 2)
+
+# =========================
+# 生成 API
+# =========================
+
+class GenerateShoesTest(unittest.TestCase):
+
+    def _generate(self, **kwargs):
+        failures = []
+        config = waa.GenerationConfig(seed=TEST_SEED, **kwargs)
+        shoes = list(waa.generate_shoes(config, on_failure=lambda idx, error: failures.append(idx)))
+        return shoes, failures
+
+    def test_num_shoes_from_first_shoe(self):
+        shoes, failures = self._generate(num_shoes=2, first_shoe=3)
+        self.assertEqual(failures, [])
+        self.assertEqual([_shoe_key(g.shoe) for g in shoes], [_shoe_key(sh) for sh in _FIXTURE['shoes'][2:4]])
+        self.assertEqual([g.attempt for g in shoes], _FIXTURE['attempts'][2:4])
+
+    def test_target_count(self):
+        shoes, _ = self._generate(num_shoes=None, target_count=3)
+        self.assertEqual([g.shoe_index for g in shoes], [1, 2, 3])
+        shoes, _ = self._generate(num_shoes=None, target_count=3, workers=2)
+        self.assertEqual([g.shoe_index for g in shoes], [1, 2, 3])
+
+    def test_time_budget(self):
+        shoes, failures = self._generate(num_shoes=None, time_budget=0.0)
+        self.assertEqual((shoes, failures), ([], []))
+        for workers in (1, 2):
+            start = time.monotonic()
+            shoes, failures = self._generate(num_shoes=None, time_budget=0.5, workers=workers)
+            self.assertLess(time.monotonic() - start, 5.0)
+            # 到期時已完成的靴照常產出，被截斷的靴序不算失敗
+            self.assertEqual([g.shoe_index for g in shoes], list(range(1, len(shoes) + 1)))
+            self.assertEqual(failures, [])
+
+    def test_leaves_global_random_state_alone(self):
+        random.seed(TEST_SEED)
+        state = random.getstate()
+        self._generate(num_shoes=2)
+        self.assertEqual(random.getstate(), state)
+
+# =========================
+# 遙測
+# =========================
+
+class TelemetryTest(unittest.TestCase):
+
+    VARIANTS = [dict(), dict(tie_suit='♣'), dict(tie_suit='♣', suit_rule_solver=False),
+                dict(min_tail_stop=40, multi_pass_min_cards=40, repair_max_rounds=0),
+                dict(rank_only_packing=False, suit_rule_solver=False)]
+
+    def test_every_attempt_counted_once(self):
+        total = waa.Telemetry()
+        for variant in self.VARIANTS:
+            params = dict(_FIXTURE['params'], max_attempts=8, **variant)
+            for seed in range(3):
+                telemetry = waa.Telemetry()
+                result = waa.generate_all_sensitive_shoe_or_retry(telemetry=telemetry, seed=seed, **params)
+                self.assertEqual(telemetry.accepted, 1 if result else 0)
+                self.assertEqual(telemetry.attempts, sum(telemetry.rejections.values()) + telemetry.accepted,
+                                 variant)
+                if result:
+                    self.assertEqual(telemetry.accepted_attempt, telemetry.attempts - 1)
+                for reason, kept in telemetry.samples.items():
+                    self.assertIn(reason, telemetry.rejections)
+                    self.assertTrue(all(s['shoe_seed'] == seed for s in kept))
+                total.merge(telemetry)
+        self.assertGreater(total.accepted, 0)
+        self.assertGreater(sum(total.rejections.values()), 0)
+        summary = total.to_dict()
+        self.assertEqual(summary['attempts'], sum(summary['rejections'].values()) + summary['accepted'])
+        self.assertGreaterEqual(summary['stages']['rules']['count'], summary['accepted'])
+
+# =========================
+# 重播與重建
+# =========================
+
+class RegenerateTest(unittest.TestCase):
+
+    def test_regenerate_by_attempt(self):
+        for sh, attempt in zip(_FIXTURE['shoes'], _FIXTURE['attempts']):
+            again, error, _ = waa.regenerate_shoe(TEST_SEED, sh.shoe_index, _FIXTURE['params'], True, attempt=attempt)
+            self.assertEqual(error, '')
+            self.assertEqual(_shoe_key(again), _shoe_key(sh))
+
+    def test_regenerate_from_first_attempt(self):
+        sh = _FIXTURE['shoes'][1]
+        again, error, _ = waa.regenerate_shoe(TEST_SEED, sh.shoe_index, _FIXTURE['params'], True)
+        self.assertEqual(error, '')
+        self.assertEqual(_shoe_key(again), _shoe_key(sh))
+
+    def test_replay_rejected_samples(self):
+        params = dict(_FIXTURE['params'], tie_suit='♣', max_attempts=6)
+        telemetry = waa.Telemetry()
+        waa.generate_all_sensitive_shoe_or_retry(telemetry=telemetry, seed=TEST_SEED, **params)
+        replayed = 0
+        for reason, kept in telemetry.samples.items():
+            for sample in kept:
+                again = waa.Telemetry()
+                self.assertIsNone(waa.replay_attempt(sample['shoe_seed'], sample['attempt'], params, again))
+                self.assertEqual(again.last_reason, reason)
+                replayed += 1
+        self.assertGreater(replayed, 0)
+
+# =========================
+# 牌靴服務
+# =========================
+
+class ServerTest(unittest.TestCase):
+    """在本行程內以 asyncio 啟動 ShoeServer（隨機埠），經真正的 TCP 連線送出請求。"""
+
+    def _serve(self, scenario, library_path: Optional[str] = None):
+        async def run():
+            server = waa_server.ShoeServer(waa.GenerationConfig(), 1, 2, library_path)
+            srv = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+            port = srv.sockets[0].getsockname()[1]
+
+            async def request(target: str, method: str = 'GET') -> Tuple[int, str, bytes]:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(f'{method} {target} HTTP/1.1\r\nHost: test\r\n\r\n'.encode('latin-1'))
+                await writer.drain()
+                data = await reader.read()
+                writer.close()
+                head, _, body = data.partition(b'\r\n\r\n')
+                _, status, phrase = head.split(b'\r\n')[0].decode('latin-1').split(' ', 2)
+                return int(status), phrase, body
+
+            try:
+                await scenario(server, request)
+            finally:
+                srv.close()
+                await srv.wait_closed()
+                server.close()
+        asyncio.run(run())
+
+    def test_endpoints(self):
+        async def scenario(server, request):
+            self.assertEqual(await request('/health'), (200, 'OK', b'{"ok": true}'))
+            status, _, body = await request('/shoe')
+            self.assertEqual(status, 200)
+            shoe = json.loads(body)
+            self.assertEqual(sum(len(r['cards']) for r in shoe['rounds']) + len((shoe['tail'] or {}).get('cards', [])),
+                             len(waa.SUITS) * len(waa.RANKS) * waa.NUM_DECKS)
+            self.assertTrue(all(r['sensitive'] for r in shoe['rounds']))
+            # HEAD 只檢查參數：不回本文、不建立新的池
+            self.assertEqual(await request('/shoe?late_diff=3', 'HEAD'), (200, 'OK', b''))
+            self.assertEqual(len(server.pools), 1)
+            self.assertEqual((await request('/nope'))[:2], (404, 'Not Found'))
+            self.assertEqual((await request('/shoe?tie_suit=x'))[:2], (400, 'Bad Request'))
+            self.assertEqual((await request('/health', 'POST'))[:2], (405, 'Method Not Allowed'))
+            metrics = json.loads((await request('/metrics'))[2])
+            pool = metrics['pools'][shoe['config_key']]
+            self.assertEqual(pool['served'], 1)
+            self.assertEqual(pool['config']['late_diff'], 2)
+        self._serve(scenario)
+
+    def test_evicts_least_recently_used_pool(self):
+        async def scenario(server, request):
+            for late_diff in (3, 4, 5, 3):
+                self.assertEqual((await request(f'/shoe?late_diff={late_diff}'))[0], 200)
+            metrics = json.loads((await request('/metrics'))[2])
+            self.assertEqual(metrics['evicted_pools'], 2)
+            self.assertEqual(sorted(p['config']['late_diff'] for p in metrics['pools'].values()), [3, 5])
+        with mock.patch.object(waa_server, 'MAX_POOLS', 2):
+            self._serve(scenario)
+
+    def test_failing_pool_is_disabled(self):
+        async def scenario(server, request):
+            tie = urllib.parse.quote('♣')
+            self.assertEqual((await request(f'/shoe?tie_suit={tie}'))[:2], (503, 'Service Unavailable'))
+            self.assertEqual((await request(f'/shoe?tie_suit={tie}', 'HEAD'))[:2], (503, 'Service Unavailable'))
+            self.assertEqual((await request('/shoe'))[0], 200)
+        with mock.patch.multiple(waa_server, JOB_MAX_ATTEMPTS=1, POOL_MAX_FAILURES=2, FAILURE_BACKOFF=0.0), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self._serve(scenario)
+
+    def test_serves_from_library(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'library.sqlite')
+            with waa.ShoeLibrary(path) as library:
+                key = library.register(waa.library_rule_config(waa.GenerationConfig().params(), True))
+                for sh in _FIXTURE['shoes'][:1]:
+                    library.add(key, sh, 0)
+
+            async def scenario(server, request):
+                status, _, body = await request('/shoe')
+                self.assertEqual((status, json.loads(body)['seed']), (200, None))
+                self.assertEqual(json.loads((await request('/metrics'))[2])['pools'][key]['from_library'], 1)
+            self._serve(scenario, path)
+
+# =========================
+# 敏感密度
+# =========================
+
+_DENSITY_HISTS = [
+    (1, 1, 1, 1, 1, 1, 1, 0, 0, 0),
+    (3, 0, 1, 0, 1, 0, 1, 1, 0, 0),
+    (2, 0, 0, 2, 0, 0, 0, 1, 1, 1),
+    (0, 1, 1, 0, 0, 1, 0, 0, 1, 1),
+    (4, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+]
+
+def _enumerated_density(hist) -> Tuple[float, ...]:
+    """把牌池視為各自不同的牌、枚舉全部排列，第一局為 4 / 5 / 6 張敏感局的比例。"""
+    cards = [pt for pt, c in enumerate(hist) for _ in range(c)]
+    hits = dict.fromkeys(waa.TAIL_LENGTHS, 0)
+    total = 0
+    for perm in itertools.permutations(cards):
+        total += 1
+        res, used, _, _ = _reference_round(list(perm[:waa.ROUND_WINDOW]) + [0] * (waa.ROUND_WINDOW - len(perm)))
+        if used <= len(perm) and _reference_sensitive(perm[:used]):
+            hits[used] += 1
+    return tuple(hits[k] / total for k in waa.TAIL_LENGTHS)
+
+class DensityTest(unittest.TestCase):
+    """密度以樣式機率加總算出，須與把牌池逐一排列、以參考實作判定第一局的結果相同。"""
+
+    def setUp(self):
+        waa._DENSITY_CACHE.clear()
+        self.addCleanup(waa._DENSITY_CACHE.clear)
+
+    def _check(self):
+        for hist in _DENSITY_HISTS:
+            d = waa.sensitivity_density(hist)
+            expected = _enumerated_density(hist)
+            for got, want in zip(d.p_by_length, expected):
+                self.assertAlmostEqual(got, want, places=12, msg=hist)
+            self.assertAlmostEqual(d.p_sensitive, sum(expected), places=12)
+            self.assertEqual(d.cards, sum(hist))
+
+    def test_matches_permutation_enumeration(self):
+        self._check()
+
+    def test_pure_python_path(self):
+        with mock.patch.object(waa, 'np', None):
+            self._check()
+
+    def test_too_few_cards(self):
+        d = waa.sensitivity_density((1, 1, 1, 0, 0, 0, 0, 0, 0, 0))
+        self.assertEqual((d.p_sensitive, d.mean_cards, d.hit_rate), (0.0, 0.0, 0.0))
+        self.assertEqual(d.reshuffle_budget(1000), 0)
+
+    def test_reshuffle_budget(self):
+        dense = waa.SensitivityDensity(cards=12, p_sensitive=0.5, p_by_length=(0.5, 0.0, 0.0), mean_cards=4.0)
+        self.assertAlmostEqual(dense.hit_rate, 0.875)
+        self.assertEqual(dense.reshuffle_budget(100), 4)
+        self.assertEqual(dense.reshuffle_budget(2), 2)
+        # 期望重洗次數（1 / hit_rate）超過上限時提早放棄
+        sparse = waa.SensitivityDensity(cards=4, p_sensitive=0.01, p_by_length=(0.01, 0.0, 0.0), mean_cards=4.0)
+        self.assertEqual(sparse.reshuffle_budget(50), 0)
+        self.assertEqual(sparse.reshuffle_budget(1000), 300)
+
+# =========================
+# 局部修補
+# =========================
+
+def _packings(n: int, rng: random.Random) -> List[Tuple[List[int], List[List[int]], List[int]]]:
+    """依序洗牌直到取得 n 組打包成功的 (點數序, 各局位置, 尾局位置)。"""
+    out = []
+    while len(out) < n:
+        points = [c.point() for c in waa.build_shuffled_deck(rng)]
+        packed = waa.pack_points_once(points, min_tail_stop=None, multi_pass_min_cards=None, rng=rng)
+        if packed:
+            out.append((points,) + packed)
+    return out
+
+class RepairTest(unittest.TestCase):
+    """把合格打包的最後一局拆回尾牌，造出剩牌張數不合的近似失敗，再交給局部修補。"""
+
+    def _assert_valid(self, points, rounds, tail):
+        used = [p for r in rounds for p in r] + list(tail)
+        self.assertEqual(sorted(used), list(range(len(points))))
+        for r in rounds:
+            self.assertTrue(_reference_sensitive([points[p] for p in r]), r)
+        self.assertTrue(waa.tail_possible([points[p] for p in tail]))
+
+    def test_repair_rebuilds_a_valid_partition(self):
+        rng = random.Random(TEST_SEED)
+        repaired = 0
+        for points, rounds, tail in _packings(40, rng):
+            rounds = sorted(rounds, key=lambda r: r[0])
+            near_rounds, near_tail = rounds[:-1], rounds[-1] + tail
+            snapshot = [list(r) for r in near_rounds]
+            out = waa.repair_near_miss(points, near_rounds, near_tail, max_rounds=waa.REPAIR_MAX_ROUNDS,
+                                       max_nodes=waa.REPAIR_MAX_NODES, rng=rng)
+            self.assertEqual(near_rounds, snapshot)
+            if out is None:
+                continue
+            repaired += 1
+            new_rounds, new_tail = out
+            self._assert_valid(points, new_rounds, new_tail)
+            # 只拆最後幾局：前面的局原樣保留
+            k = len(near_rounds) - waa.REPAIR_MAX_ROUNDS
+            self.assertEqual(new_rounds[:max(k, 0)], near_rounds[:max(k, 0)])
+        self.assertGreater(repaired, 0)
+
+    def test_repair_is_reproducible_from_rng(self):
+        points, rounds, tail = _packings(1, random.Random(TEST_SEED))[0]
+        near_rounds, near_tail = rounds[:-1], rounds[-1] + tail
+        runs = [waa.repair_near_miss(points, near_rounds, near_tail, max_rounds=waa.REPAIR_MAX_ROUNDS,
+                                     max_nodes=waa.REPAIR_MAX_NODES, rng=random.Random(seed))
+                for seed in (TEST_SEED, TEST_SEED)]
+        self.assertIsNotNone(runs[0])
+        self.assertEqual(runs[0], runs[1])
+
+    def test_partition_sensitive_groups(self):
+        rng = random.Random(TEST_SEED)
+        for _ in range(50):
+            hist = [0] * 10
+            for _ in range(rng.randint(8, 24)):
+                hist[rng.randrange(10)] += 1
+            groups = waa.partition_sensitive(hist, max_nodes=waa.REPAIR_MAX_NODES, rng=rng)
+            if groups is None:
+                continue
+            total = [0] * 10
+            for counts in groups:
+                ms = [pt for pt, c in counts for _ in range(c)]
+                self.assertIsNotNone(waa.sensitive_tail_order(ms))
+                for pt, c in counts:
+                    total[pt] += c
+            self.assertEqual(total, hist)
+
+# =========================
+# 母體統計
+# =========================
+
+def _assert_close(case: unittest.TestCase, a, b, path: str = '') -> None:
+    """遞迴比較 JSON 類結構；浮點數容許捨入誤差。"""
+    if isinstance(a, float) or isinstance(b, float):
+        case.assertAlmostEqual(a, b, places=9, msg=path)
+    elif isinstance(a, dict):
+        case.assertEqual(set(a), set(b), path)
+        for k in a:
+            _assert_close(case, a[k], b[k], f"{path}.{k}")
+    elif isinstance(a, (list, tuple)):
+        case.assertEqual(len(a), len(b), path)
+        for i, (x, y) in enumerate(zip(a, b)):
+            _assert_close(case, x, y, f"{path}[{i}]")
+    else:
+        case.assertEqual(a, b, path)
+
+class PopulationStatsTest(unittest.TestCase):
+    """分段累計再 merge 須與一次累計相同；平均與切牌曲線須與逐靴切牌模擬一致。"""
+
+    def test_merge_matches_single_pass(self):
+        shoes = _FIXTURE['shoes']
+        whole = waa.PopulationStats()
+        for sh in shoes:
+            whole.add(sh)
+        for split in range(len(shoes) + 1):
+            left, right = waa.PopulationStats(), waa.PopulationStats()
+            for sh in shoes[:split]:
+                left.add(sh)
+            for sh in shoes[split:]:
+                right.add(sh)
+            left.merge(right)
+            _assert_close(self, left.to_dict(), whole.to_dict())
+
+    def test_matches_cut_simulation(self):
+        stats = waa.PopulationStats()
+        results = [waa.generated_shoe(sh, None) for sh in _FIXTURE['shoes']]
+        for g in results:
+            stats.add(g.shoe)
+        n = len(results)
+        self.assertAlmostEqual(stats.avg_hit.mean, sum(g.cut.avg_hit for g in results) / n, places=9)
+        self.assertAlmostEqual(stats.avg_rounds.mean, sum(g.cut.avg_rounds for g in results) / n, places=9)
+        for pos, played, hits in stats.cut_curve():
+            if pos > len(results[0].cut.rows):
+                continue
+            self.assertAlmostEqual(played, round(sum(g.cut.rows[pos - 1][1] for g in results) / n, 4))
+            self.assertAlmostEqual(hits, round(sum(g.cut.rows[pos - 1][2] for g in results) / n, 4))
+
+    def test_archive_ranges_merge(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'shoes.waa')
+            with waa.ShoeArchiveWriter(path, {}) as w:
+                for sh in _FIXTURE['shoes']:
+                    w.append(sh)
+            whole = waa._archive_stats_range(path, 0, TEST_SHOES)
+            parts = waa._archive_stats_range(path, 0, 1)
+            parts.merge(waa._archive_stats_range(path, 1, TEST_SHOES))
+            _assert_close(self, parts.to_dict(), whole.to_dict())
+            _assert_close(self, waa.archive_population_stats(path).to_dict(), whole.to_dict())
+            _assert_close(self, waa.archive_population_stats(path, workers=2).to_dict(), whole.to_dict())
+
+# =========================
+# 切牌重發
+# =========================
+
+class RedealTest(unittest.TestCase):
+    """redeal_cut_matrix（numpy 分批與純 Python 逐一）須與逐靴逐切點的 redeal_shoe 相同。"""
+
+    OFFSETS = [0, 1, 37, 208, 415]
+    SETTINGS = [dict(burn=0, penetration=None), dict(burn=None, penetration=None),
+                dict(burn=5, penetration=(300, 360)), dict(burn=None, penetration=(100, 120))]
+
+    def _reference(self, shoes, **kwargs):
+        return [[waa.redeal_shoe(sh.codes, c, **kwargs) for c in self.OFFSETS] for sh in shoes]
+
+    def _assert_matches(self, played, hits, expected):
+        for i, row in enumerate(expected):
+            for j, (p, h) in enumerate(row):
+                self.assertAlmostEqual(float(played[i][j]), p, places=9)
+                self.assertAlmostEqual(float(hits[i][j]), h, places=9)
+
+    def test_matrix_matches_reference(self):
+        shoes = _FIXTURE['shoes']
+        for kwargs in self.SETTINGS:
+            expected = self._reference(shoes, **kwargs)
+            self._assert_matches(*waa.redeal_cut_matrix(shoes, self.OFFSETS, batch_size=3, **kwargs), expected)
+            with mock.patch.object(waa, 'np', None):
+                self._assert_matches(*waa.redeal_cut_matrix(shoes, iter(self.OFFSETS), **kwargs), expected)
+
+    def test_offset_zero_replays_the_shoe(self):
+        for sh in _FIXTURE['shoes']:
+            played, hits = waa.redeal_shoe(sh.codes, 0)
+            spans = sh.round_spans()
+            tail = 1 if sh.tail_len else 0
+            self.assertEqual(played, len(spans) + tail)
+            self.assertEqual(hits, sum(s for *_, s in spans) + tail)
+
+    def test_unequal_lengths(self):
+        sh = _FIXTURE['shoes'][0]
+        short = waa.CompactShoe(0, bytes(sh.codes[:-4]), b'', b'', 0)
+        with self.assertRaises(ValueError):
+            waa.redeal_cut_matrix([sh, short], [0])
+        with mock.patch.object(waa, 'np', None), self.assertRaises(ValueError):
+            waa.redeal_cut_matrix([sh, short], [0])
+
+# =========================
+# 花色求解
+# =========================
+
+def _suit_state(views) -> List[Tuple[str, str]]:
+    return [(c.rank, c.suit) for rv in views for c in rv.cards]
+
+class SuitSolverTest(unittest.TestCase):
+    """每組打包都以新綁的花色分別交給求解器與貪婪流程（各用一份複本）。"""
+
+    CASES = [('♥', None), ('♥', '♣'), (None, '♣')]
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(TEST_SEED)
+        cls.shoes = []
+        while len(cls.shoes) < 30:
+            packed = waa.pack_all_sensitive_once(waa.build_shuffled_deck(rng), min_tail_stop=None,
+                                                 multi_pass_min_cards=None, rng=rng)
+            if packed:
+                cls.shoes.append(waa.CompactShoe.from_rounds(0, *packed))
+
+    def _views(self, shoe: waa.CompactShoe):
+        sr = shoe.materialize()
+        return waa.shoe_round_views(sr.rounds, sr.tail)
+
+    def _check_solution(self, views, signal_suit: Optional[str], tie_suit: Optional[str]):
+        if tie_suit:
+            waa.validate_tie_signal(views, tie_suit)
+        s_idx = waa.compute_sidx_new(views) if signal_suit and signal_suit != tie_suit else []
+        if s_idx:
+            s_set = set(s_idx)
+            strict = all(i in s_set for i, rv in enumerate(views) for c in rv.cards if c.suit == signal_suit)
+            covered = all(any(c.suit == signal_suit for c in views[i].cards) for i in s_idx)
+            self.assertTrue(strict or covered)
+        counts = collections.Counter(c.suit for rv in views for c in rv.cards)
+        self.assertTrue(waa._suit_counts_balanced(counts, 2, signal_suit, tie_suit))
+
+    def test_solutions_satisfy_rules(self):
+        accepted = 0
+        for signal_suit, tie_suit in self.CASES:
+            for shoe in self.shoes:
+                views = self._views(shoe)
+                before = _suit_state(views)
+                reason = waa.solve_suit_rules(views, signal_suit=signal_suit, tie_suit=tie_suit, late_diff=2)
+                after = _suit_state(views)
+                if reason is None:
+                    accepted += 1
+                    self.assertEqual(collections.Counter(before), collections.Counter(after))
+                    self.assertEqual([r for r, _ in before], [r for r, _ in after])
+                    self._check_solution(views, signal_suit, tie_suit)
+                else:
+                    self.assertEqual(before, after, reason)
+        self.assertGreater(accepted, 0)
+
+    def test_accepts_whatever_greedy_accepts(self):
+        for signal_suit, tie_suit in self.CASES:
+            for shoe in self.shoes:
+                kwargs = dict(signal_suit=signal_suit, tie_suit=tie_suit, late_diff=2)
+                sr = shoe.materialize()
+                greedy = waa.shoe_rules_rejection(sr.rounds, sr.tail, suit_rule_solver=False, **kwargs)
+                solved = waa.solve_suit_rules(self._views(shoe), **kwargs)
+                if greedy is None:
+                    self.assertIsNone(solved, (signal_suit, tie_suit))
+
+if __name__ == '__main__':
+    unittest.main()
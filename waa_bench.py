@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+waa.py 生成流程的效能基準（固定種子、可重現）。
+
+- 微基準（micro）：simulate_round、scan_all_sensitive_rounds、try_make_tail_sensitive、
+  enforce_suit_distribution、late_balance、solve_suit_rules、sensitivity_density、simulate_cut_positions、redeal_cut_matrix；每項回報每次呼叫的中位數耗時。
+- 巨基準（macro）：打包嘗試數 / 秒、靴 / 小時、冷啟動到第一副靴的時間（另開子行程量測）。
+- 每次執行附加一行到歷史檔（JSON Lines），並與基準檔比較；超過門檻者標示為退步，結束碼為 1。
+
+使用方式：
+- python waa_bench.py                     ：完整執行並與基準比較
+- python waa_bench.py --quick             ：減少重複次數與靴數（快速檢查）
+- python waa_bench.py --only micro        ：只跑微基準（或 macro）
+- python waa_bench.py --save-baseline     ：把本次結果存為新的基準
+"""
+from __future__ import annotations
+from typing import List, Dict, Callable, Optional, Tuple
+import argparse, json, os, platform, random, statistics, subprocess, sys, time
+
+import waa
+
+BENCH_SEED = 20240601
+HISTORY_FILE = 'waa_bench_history.jsonl'
+BASELINE_FILE = 'waa_bench_baseline.json'
+DEFAULT_THRESHOLD = 0.15   # 與基準相差超過 15% 視為退步
+
+# 指標方向：耗時越小越好、吞吐量越大越好
+LOWER_IS_BETTER = 'lower'
+HIGHER_IS_BETTER = 'higher'
+
+# =========================
+# 固定種子的測試資料
+# =========================
+
+class Fixtures:
+    """所有微基準共用的固定資料：一副洗好的牌、一副可套規則的打包結果、一批尾局樣本。"""
+
+    def __init__(self, seed: int = BENCH_SEED):
+        random.seed(seed)
+        self.deck = waa.build_shuffled_deck()
+        self.packed = self._find_packed_shoe()
+        self.tails = self._tail_samples(200)
+
+    @staticmethod
+    def _find_packed_shoe() -> waa.CompactShoe:
+        """依序洗牌直到打包成功且花色規則可行；以精簡牌靴保存，每次 setup 還原出新的 Card 物件。"""
+        while True:
+            result = waa.pack_all_sensitive_once(
+                waa.build_shuffled_deck(),
+                min_tail_stop=waa.MIN_TAIL_STOP, multi_pass_min_cards=waa.MULTI_PASS_MIN_CARDS)
+            if not result:
+                continue
+            rounds, tail = result
+            views = waa.shoe_round_views(rounds, tail)
+            if waa.check_rules_feasibility(views, signal_suit=waa.SIGNAL_SUIT, tie_suit=None):
+                continue
+            return waa.CompactShoe.from_rounds(0, rounds, tail)
+
+    @staticmethod
+    def _tail_samples(n: int) -> List[List[waa.Card]]:
+        samples = []
+        while len(samples) < n:
+            deck = waa.build_shuffled_deck()
+            k = random.choice(waa.TAIL_LENGTHS)
+            samples.append(deck[:k])
+        return samples
+
+    def fresh_views(self):
+        sr = self.packed.materialize()
+        views = waa.shoe_round_views(sr.rounds, sr.tail)
+        return sr, views, waa.SuitInventory(views)
+
+# =========================
+# 微基準
+# =========================
+# 每個案例為 (setup, run, 每次 run 的呼叫數)；只計 run 的時間，setup 每次重新建立可變狀態。
+
+def _micro_cases(fx: Fixtures) -> Dict[str, Tuple[Callable[[], object], Callable[[object], None], int]]:
+    starts = list(range(0, len(fx.deck) - 4))
+
+    def sim_setup():
+        return waa.Simulator(fx.deck)
+
+    def sim_run(sim):
+        for s in starts:
+            sim.simulate_round(s)
+
+    def scan_run(sim):
+        waa.scan_all_sensitive_rounds(sim)
+
+    def tail_run(_):
+        for t in fx.tails:
+            waa.try_make_tail_sensitive(t)
+
+    def enforce_setup():
+        _, views, inv = fx.fresh_views()
+        return views, waa.compute_sidx_new(views), inv
+
+    def enforce_run(state):
+        views, s_idx, inv = state
+        try:
+            waa.enforce_suit_distribution(views, waa.SIGNAL_SUIT, s_idx, inv)
+        except (RuntimeError, AssertionError):
+            pass
+
+    def balance_setup():
+        return fx.fresh_views()[1:]
+
+    def balance_run(state):
+        views, inv = state
+        waa.late_balance(views, inv, waa.LATE_BALANCE_DIFF, waa.SIGNAL_SUIT)
+
+    def solve_setup():
+        return fx.fresh_views()[1]
+
+    def solve_run(views):
+        waa.solve_suit_rules(views, signal_suit=waa.SIGNAL_SUIT, tie_suit=None, late_diff=waa.LATE_BALANCE_DIFF)
+
+    def density_setup():
+        waa._DENSITY_CACHE.clear()
+        return [waa.point_hist(t) for t in fx.tails]
+
+    def density_run(hists):
+        for h in hists:
+            waa.sensitivity_density(h)
+
+    def cut_setup():
+        sr = fx.packed.materialize()
+        return sr.rounds, sr.tail
+
+    def cut_run(state):
+        waa.simulate_cut_positions(*state)
+
+    def redeal_setup():
+        return [fx.packed]
+
+    def redeal_run(shoes):
+        waa.redeal_cut_matrix(shoes, burn=None)
+
+    return {
+        'simulate_round': (sim_setup, sim_run, len(starts)),
+        'scan_all_sensitive_rounds': (sim_setup, scan_run, 1),
+        'try_make_tail_sensitive': (lambda: None, tail_run, len(fx.tails)),
+        'enforce_suit_distribution': (enforce_setup, enforce_run, 1),
+        'late_balance': (balance_setup, balance_run, 1),
+        'solve_suit_rules': (solve_setup, solve_run, 1),
+        'sensitivity_density': (density_setup, density_run, len(fx.tails)),
+        'simulate_cut_positions': (cut_setup, cut_run, 1),
+        'redeal_cut_matrix': (redeal_setup, redeal_run, 1),
+    }
+
+def run_micro(repeat: int, selected: Optional[List[str]] = None) -> Dict[str, dict]:
+    fx = Fixtures()
+    # 預熱：尾局查表等惰性建立的快取不計入
+    waa.try_make_tail_sensitive(fx.tails[0])
+    results = {}
+    for name, (setup, run, calls) in _micro_cases(fx).items():
+        if selected and name not in selected:
+            continue
+        samples = []
+        for _ in range(repeat):
+            state = setup()
+            t0 = time.perf_counter()
+            run(state)
+            samples.append((time.perf_counter() - t0) / calls)
+        results[name] = dict(
+            value=statistics.median(samples) * 1e6, unit='us/call', better=LOWER_IS_BETTER,
+            min=min(samples) * 1e6, repeat=repeat,
+        )
+        print(f"  {name:<28} {results[name]['value']:>12.2f} us/call  (min {results[name]['min']:.2f})")
+    return results
+
+# =========================
+# 巨基準
+# =========================
+
+def run_macro(num_shoes: int) -> Dict[str, dict]:
+    config = waa.GenerationConfig()
+    params = config.params()
+    attempts = 0
+    shoes = 0
+    t_start = time.perf_counter()
+    for i in range(1, num_shoes + 1):
+        telemetry = waa.Telemetry()
+        result = waa.generate_all_sensitive_shoe_or_retry(telemetry=telemetry, seed=waa.derive_seed(BENCH_SEED, i),
+                                                          **params)
+        attempts += telemetry.attempts
+        shoes += 1 if result else 0
+    elapsed = time.perf_counter() - t_start
+    results = {
+        'pack_attempts_per_sec': dict(value=attempts / elapsed, unit='attempts/s', better=HIGHER_IS_BETTER),
+        'shoes_per_hour': dict(value=shoes / elapsed * 3600, unit='shoes/h', better=HIGHER_IS_BETTER),
+        'time_to_first_shoe': dict(value=_time_to_first_shoe(), unit='s', better=LOWER_IS_BETTER),
+    }
+    for name, r in results.items():
+        print(f"  {name:<28} {r['value']:>12.2f} {r['unit']}")
+    return results
+
+_TTFS_CHILD = '''
+import time, sys
+t0 = time.perf_counter()
+sys.path.insert(0, {path!r})
+import waa
+for _ in waa.generate_shoes(waa.GenerationConfig(seed={seed}, num_shoes=None, target_count=1)):
+    break
+print(time.perf_counter() - t0)
+'''
+
+def _time_to_first_shoe() -> float:
+    """冷啟動（新行程：匯入 + 建表 + 第一副靴）到取得第一副合格靴的秒數。"""
+    code = _TTFS_CHILD.format(path=os.path.dirname(os.path.abspath(waa.__file__)), seed=BENCH_SEED)
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+# =========================
+# 歷史紀錄與基準比較
+# =========================
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(current: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """回傳退步的指標名稱，並印出與基準的比較。"""
+    regressions = []
+    for name, r in current.items():
+        base = baseline.get(name)
+        if not base or not base.get('value'):
+            continue
+        ratio = r['value'] / base['value']
+        if r['better'] == LOWER_IS_BETTER:
+            worse, better = ratio > 1 + threshold, ratio < 1 - threshold
+        else:
+            worse, better = ratio < 1 - threshold, ratio > 1 + threshold
+        flag = '退步' if worse else ('進步' if better else '')
+        print(f"  {name:<28} {base['value']:>12.2f} → {r['value']:>12.2f} {r['unit']:<10} x{ratio:.2f} {flag}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description='waa.py 效能基準')
+    ap.add_argument('--only', choices=('micro', 'macro'))
+    ap.add_argument('--cases', help='只跑指定的微基準（逗號分隔）')
+    ap.add_argument('--quick', action='store_true', help='減少重複次數與靴數')
+    ap.add_argument('--history', default=HISTORY_FILE)
+    ap.add_argument('--baseline', default=BASELINE_FILE)
+    ap.add_argument('--save-baseline', action='store_true')
+    ap.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = ap.parse_args(argv)
+
+    results: Dict[str, dict] = {}
+    if args.only != 'macro':
+        print('=== 微基準 ===')
+        results.update(run_micro(5 if args.quick else 30, args.cases.split(',') if args.cases else None))
+    if args.only != 'micro':
+        print('=== 巨基準 ===')
+        results.update(run_macro(3 if args.quick else 20))
+
+    record = dict(
+        timestamp=time.time(), commit=_git_commit(), python=platform.python_version(),
+        numpy=waa.np.__version__ if waa.np is not None else None, seed=BENCH_SEED,
+        quick=args.quick, results=results,
+    )
+    with open(args.history, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    regressions: List[str] = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"=== 與基準比較（{baseline.get('commit') or '-'}，門檻 ±{args.threshold:.0%}）===")
+        regressions = compare(results, baseline['results'], args.threshold)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+        print(f"已儲存基準：{args.baseline}")
+    if regressions:
+        print(f"偵測到退步：{', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本機牌靴服務（asyncio + HTTP/JSON，只用標準函式庫）。
+
+- 每個規則設定各有一個有上限的預熱池；背景工作行程（generate_shoe_job）持續補滿，
+  請求直接從池中取出預先轉好的 JSON，通常在數毫秒內回應。
+- 服務端的工作有嘗試次數與時間上限，每個池最多占用一部分工作行程；連續失敗的池會退避，
+  失敗過多即停用，避免幾乎不可能成功的規則設定（例如和局花色）拖垮其他池。
+- 指定 --library 時，池先從牌靴庫存（waa.ShoeLibrary）取靴，不足才現場生成；
+  同時啟動背景補貨行程（waa.start_library_filler），讓預設規則設定的庫存在服務期間維持 --library-stock 靴。
+- 池的數量有上限（MAX_POOLS）；滿了時先移除已停用的池，再移除最久未使用且無人等待的池（LRU）。
+- 前端頁面可直接 fetch（已加 CORS 標頭）。
+
+端點：
+- GET /shoe?signal_suit=♥&tie_suit=&late_diff=2&color_rule=1   取一副靴（池空時等待下一副完成）
+- GET /metrics                                                 各池深度、進行中工作數、補貨速率等
+- GET /health
+
+使用方式：
+- python waa_server.py --port 8765 --pool-size 8 --workers 4
+- python waa_server.py --library shoe_library.sqlite3 --library-stock 200
+"""
+from __future__ import annotations
+from dataclasses import replace
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+import argparse, asyncio, collections, http, itertools, json, random, time
+
+import waa
+
+DEFAULT_PORT = 8765
+DEFAULT_POOL_SIZE = 8
+MAX_POOLS = 16             # 同時存在的規則設定池上限（避免任意查詢參數耗盡資源）
+RATE_WINDOW = 60.0         # 補貨速率的統計視窗（秒）
+RATE_MIN_WINDOW = 5.0      # 新建的池至少以此秒數計算速率，避免首批完成時數值暴衝
+SHOE_WAIT_TIMEOUT = 600.0  # 池空時等待新靴的上限（秒）
+JOB_MAX_ATTEMPTS = 2000    # 服務端每個工作的嘗試次數上限（取代 CONFIG 的 MAX_ATTEMPTS）
+JOB_TIME_BUDGET = 30.0     # 服務端每個工作的時間上限（秒）
+POOL_WORKER_SHARE = 0.5    # 每個池同時進行的工作數上限占全部工作行程的比例（至少 1）
+FAILURE_BACKOFF = 2.0      # 工作失敗後暫停補貨的秒數，連續失敗時加倍
+FAILURE_BACKOFF_MAX = 60.0
+POOL_MAX_FAILURES = 5      # 連續失敗達此次數即停用該池（之後的請求直接回 503）
+LIBRARY_POLL_INTERVAL = 5.0  # 背景補貨行程補滿後，每隔此秒數檢查一次庫存
+
+# =========================
+# 牌靴 → JSON
+# =========================
+
+def shoe_to_json(g: waa.GeneratedShoe) -> dict:
+    """前端使用的牌靴格式：各局牌面（如 "3♣"）、顏色字串（R/B）、結果與切牌統計。"""
+    def cards_json(cards):
+        return dict(cards=[c.short() for c in cards], colors=''.join(c.color or '-' for c in cards))
+
+    rounds = [dict(start=r.start_index, result=r.result, sensitive=r.sensitive, **cards_json(r.cards))
+              for r in g.rounds]
+    tail = dict(result=waa._seq_result(g.tail), **cards_json(g.tail)) if g.tail else None
+    return dict(
+        rounds=rounds, tail=tail,
+        avg_hit=round(g.cut.avg_hit, 4), avg_rounds=round(g.cut.avg_rounds, 4),
+        seed=g.seed, attempt=g.attempt, elapsed=round(g.shoe.elapsed, 4),
+    )
+
+# =========================
+# 預熱池
+# =========================
+
+class PoolDisabled(RuntimeError):
+    """池因連續失敗而停用。"""
+
+class PoolsBusy(RuntimeError):
+    """池數已達上限，且每個池都有請求在等待，無法移除任何一個。"""
+
+class ShoePool:
+    """單一規則設定的預熱池：depth + in_flight 維持在 capacity，每個池最多同時 max_in_flight 個工作。
+    工作失敗時依連續失敗次數退避，連續 POOL_MAX_FAILURES 次即停用。"""
+
+    def __init__(self, key: str, config: waa.GenerationConfig, capacity: int, max_in_flight: int,
+                 executor: ProcessPoolExecutor, library: Optional[waa.ShoeLibrary] = None):
+        self.key = key
+        self.config = config
+        self.capacity = capacity
+        self.max_in_flight = max_in_flight
+        self.executor = executor
+        self.library = library
+        self.from_library = 0
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.in_flight = 0
+        self.served = 0
+        self.generated = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.disabled: Optional[str] = None
+        self.waiters = 0
+        self._resume_at = 0.0
+        self.gen_seconds = 0.0
+        self.completed_at: collections.deque = collections.deque()
+        self.created = time.time()
+        self._wakeup = asyncio.Event()
+        self._session_seed = random.SystemRandom().randrange(2 ** 63)
+        self._counter = itertools.count(1)
+        self._task = asyncio.get_running_loop().create_task(self._refill_loop())
+
+    async def _refill_loop(self):
+        params = self.config.params()
+        while self.disabled is None:
+            delay = self._resume_at - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self._take_from_library()
+            while self.ready.qsize() + self.in_flight < self.capacity and self.in_flight < self.max_in_flight:
+                idx = next(self._counter)
+                seed = waa.derive_seed(self._session_seed, idx)
+                fut = asyncio.get_running_loop().run_in_executor(
+                    self.executor, waa.generate_shoe_job, idx, seed, params, self.config.color_rule,
+                    0.0, JOB_TIME_BUDGET)
+                self.in_flight += 1
+                fut.add_done_callback(lambda f, seed=seed: self._on_done(f, seed))
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def _on_done(self, fut: asyncio.Future, seed: int):
+        self.in_flight -= 1
+        self._wakeup.set()
+        if fut.cancelled():
+            return
+        exc = fut.exception()
+        if exc is not None:
+            self._fail(f"工作失敗：{exc!r}")
+            return
+        _, shoe, error, telemetry = fut.result()
+        if shoe is None:
+            self._fail(error)
+            return
+        self.consecutive_failures = 0
+        self.generated += 1
+        self.gen_seconds += shoe.elapsed
+        self.completed_at.append(time.time())
+        self._put(waa.generated_shoe(shoe, seed, telemetry.accepted_attempt))
+
+    def _put(self, g: waa.GeneratedShoe):
+        # 在事件迴圈中先轉好 JSON，取靴時只剩出列與寫出
+        body = json.dumps(dict(shoe_to_json(g), config_key=self.key), ensure_ascii=False).encode('utf-8')
+        self.ready.put_nowait(body)
+
+    def _take_from_library(self):
+        """池的空位先由庫存補上（同一規則設定、先進先出）；庫存不足的部分才交給工作行程生成。"""
+        missing = self.capacity - self.ready.qsize() - self.in_flight
+        if self.library is None or missing <= 0:
+            return
+        for shoe in self.library.take(self.key, missing):
+            self.from_library += 1
+            self._put(waa.generated_shoe(shoe, None))
+
+    def _fail(self, message: str):
+        """記錄一次失敗：連續失敗時退避，達 POOL_MAX_FAILURES 即停用並喚醒所有等待者。"""
+        self.failures += 1
+        self.consecutive_failures += 1
+        print(f"[池 {self.key}] {message}")
+        if self.consecutive_failures >= POOL_MAX_FAILURES:
+            self.disabled = f"連續 {self.consecutive_failures} 次生成失敗，此規則設定已停用"
+            print(f"[池 {self.key}] {self.disabled}")
+            for _ in range(self.waiters):
+                self.ready.put_nowait(None)
+            return
+        backoff = min(FAILURE_BACKOFF * 2 ** (self.consecutive_failures - 1), FAILURE_BACKOFF_MAX)
+        self._resume_at = max(self._resume_at, time.time() + backoff)
+
+    async def take(self) -> bytes:
+        """取出一副靴的 JSON；池已停用時拋出 PoolDisabled。"""
+        if self.disabled is not None and self.ready.empty():
+            raise PoolDisabled(self.disabled)
+        self.waiters += 1
+        try:
+            body = await asyncio.wait_for(self.ready.get(), SHOE_WAIT_TIMEOUT)
+        finally:
+            self.waiters -= 1
+        if body is None:
+            raise PoolDisabled(self.disabled)
+        self.served += 1
+        self._wakeup.set()
+        return body
+
+    def metrics(self) -> dict:
+        now = time.time()
+        while self.completed_at and now - self.completed_at[0] > RATE_WINDOW:
+            self.completed_at.popleft()
+        window = min(RATE_WINDOW, max(RATE_MIN_WINDOW, now - self.created))
+        return dict(
+            depth=self.ready.qsize(), capacity=self.capacity, in_flight=self.in_flight,
+            max_in_flight=self.max_in_flight, served=self.served, generated=self.generated,
+            from_library=self.from_library,
+            failures=self.failures, consecutive_failures=self.consecutive_failures, disabled=self.disabled,
+            refill_per_min=round(len(self.completed_at) / window * 60, 3),
+            avg_generate_s=round(self.gen_seconds / self.generated, 4) if self.generated else None,
+            config=waa.library_rule_config(self.config.params(), self.config.color_rule),
+        )
+
+    def close(self):
+        self._task.cancel()
+
+# =========================
+# HTTP 服務
+# =========================
+
+class ShoeServer:
+    """依查詢參數決定規則設定，對應到（必要時新建的）預熱池。"""
+
+    def __init__(self, base: waa.GenerationConfig, pool_size: int, workers: int,
+                 library_path: Optional[str] = None):
+        # 服務端工作一律使用較小的嘗試上限（時間上限見 JOB_TIME_BUDGET）
+        base = replace(base, max_attempts=min(base.max_attempts, JOB_MAX_ATTEMPTS))
+        self.base = base
+        self.pool_size = pool_size
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        # 先讓工作行程啟動：池由庫存補滿時第一件工作可能在處理連線時才送出，
+        # 屆時 fork 出的工作行程會繼承該連線，使連線永遠不會關閉
+        self.executor.submit(int).result()
+        self.library = waa.ShoeLibrary(library_path) if library_path else None
+        self.pools: 'collections.OrderedDict[str, ShoePool]' = collections.OrderedDict()  # 依最近使用排序
+        self.evicted = 0
+        self.started = time.time()
+
+    def config_from_query(self, query: Dict[str, list]) -> waa.GenerationConfig:
+        def opt_suit(name: str, default: Optional[str]) -> Optional[str]:
+            if name not in query:
+                return default
+            value = query[name][0].strip()
+            if value in ('', 'none', 'None'):
+                return None
+            if value not in waa.SUITS:
+                raise ValueError(f"{name} 須為 {''.join(waa.SUITS)} 之一或留空")
+            return value
+
+        def opt_int(name: str, default: Optional[int]) -> Optional[int]:
+            if name not in query:
+                return default
+            value = query[name][0].strip()
+            return None if value in ('', 'none', 'None') else int(value)
+
+        color = query.get('color_rule', [None])[0]
+        return replace(
+            self.base,
+            signal_suit=opt_suit('signal_suit', self.base.signal_suit),
+            tie_suit=opt_suit('tie_suit', self.base.tie_suit),
+            late_diff=int(query['late_diff'][0]) if 'late_diff' in query else self.base.late_diff,
+            min_tail_stop=opt_int('min_tail_stop', self.base.min_tail_stop),
+            multi_pass_min_cards=opt_int('multi_pass_min_cards', self.base.multi_pass_min_cards),
+            color_rule=self.base.color_rule if color is None else color not in ('0', 'false', 'False'),
+        )
+
+    def pool_for(self, config: waa.GenerationConfig) -> ShoePool:
+        key = waa.library_config_key(waa.library_rule_config(config.params(), config.color_rule))
+        pool = self.pools.get(key)
+        if pool is not None:
+            self.pools.move_to_end(key)
+        else:
+            if len(self.pools) >= MAX_POOLS:
+                self._evict()
+            max_in_flight = max(1, int(self.workers * POOL_WORKER_SHARE))
+            pool = self.pools[key] = ShoePool(key, config, self.pool_size, max_in_flight, self.executor, self.library)
+        return pool
+
+    def _evict(self):
+        """移除一個池騰出位置：優先移除已停用的池，其次是最久未使用且沒有請求在等待的池。"""
+        idle = [k for k, p in self.pools.items() if not p.waiters]
+        victim = next((k for k in idle if self.pools[k].disabled is not None), idle[0] if idle else None)
+        if victim is None:
+            raise PoolsBusy(f"規則設定池已達上限 {MAX_POOLS}，且各池都有請求在等待")
+        self.pools.pop(victim).close()
+        self.evicted += 1
+
+    def metrics(self) -> dict:
+        return dict(
+            uptime_s=round(time.time() - self.started, 1), workers=self.workers, evicted_pools=self.evicted,
+            pools={key: pool.metrics() for key, pool in self.pools.items()},
+        )
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # 略過標頭
+            parts = request_line.split()
+            if len(parts) < 2:
+                return
+            method, target = parts[0], parts[1]
+            url = urlsplit(target)
+            status, body = await self.route(method, url.path, parse_qs(url.query, keep_blank_values=True))
+        except Exception as e:  # 單一連線的錯誤不影響服務
+            method, status, body = None, 500, json.dumps(dict(error=repr(e))).encode('utf-8')
+        head = (f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                "Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Access-Control-Allow-Origin: *\r\n"
+                "Connection: close\r\n\r\n")
+        # HEAD 只回標頭
+        writer.write(head.encode('latin-1') + (b'' if method == 'HEAD' else body))
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, query: Dict[str, list]) -> Tuple[int, bytes]:
+        def as_json(obj) -> bytes:
+            return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+        if method not in ('GET', 'HEAD'):
+            return 405, as_json(dict(error='只支援 GET'))
+        if path == '/health':
+            return 200, as_json(dict(ok=True))
+        if path == '/metrics':
+            return 200, as_json(self.metrics())
+        if path == '/shoe':
+            try:
+                config = self.config_from_query(query)
+                if method == 'HEAD':
+                    # 只檢查參數與池狀態：不建立池、不取走池中的靴
+                    pool = self.pools.get(waa.library_config_key(
+                        waa.library_rule_config(config.params(), config.color_rule)))
+                    if pool is not None and pool.disabled is not None:
+                        return 503, as_json(dict(error=pool.disabled))
+                    return 200, b''
+                pool = self.pool_for(config)
+            except ValueError as e:
+                return 400, as_json(dict(error=str(e)))
+            except PoolsBusy as e:
+                return 503, as_json(dict(error=str(e)))
+            try:
+                return 200, await pool.take()
+            except asyncio.TimeoutError:
+                return 503, as_json(dict(error='等待新靴逾時'))
+            except PoolDisabled as e:
+                return 503, as_json(dict(error=str(e)))
+        return 404, as_json(dict(error='找不到路徑'))
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.library is not None:
+            self.library.close()
+
+async def serve(host: str, port: int, pool_size: int, workers: int,
+                library_path: Optional[str] = None, library_stock: int = 0):
+    server = ShoeServer(waa.GenerationConfig.from_globals(), pool_size, workers, library_path)
+    filler = None
+    if library_path and library_stock > 0:
+        # 預設規則設定的庫存由背景行程持續補滿（使用服務端的嘗試上限，見 ShoeServer）
+        filler = waa.start_library_filler(library_path, server.base.params(), server.base.color_rule,
+                                          library_stock, poll_interval=LIBRARY_POLL_INTERVAL)
+    server.pool_for(server.base)  # 預設設定的池啟動即開始預熱
+    srv = await asyncio.start_server(server.handle, host, port)
+    print(f"牌靴服務啟動：http://{host}:{port}（池容量 {pool_size}，工作行程 {workers}"
+          f"{f'，庫存 {library_path} 目標 {library_stock} 靴' if filler else ''}）")
+    try:
+        async with srv:
+            await srv.serve_forever()
+    finally:
+        server.close()
+        if filler is not None:
+            proc, stop_event = filler
+            stop_event.set()
+            proc.join(JOB_TIME_BUDGET)
+            if proc.is_alive():
+                proc.terminate()
+
+def main():
+    ap = argparse.ArgumentParser(description='本機牌靴服務')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=DEFAULT_PORT)
+    ap.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE)
+    ap.add_argument('--workers', type=int, default=max(1, waa.WORKERS))
+    ap.add_argument('--library', default=waa.SHOE_LIBRARY_PATH if waa.USE_SHOE_LIBRARY else None,
+                    help='牌靴庫存檔；池先自庫存取靴')
+    ap.add_argument('--library-stock', type=int, default=waa.SHOE_LIBRARY_STOCK,
+                    help='背景補貨維持的庫存靴數（0 表示只取用、不補貨）')
+    args = ap.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.pool_size, args.workers, args.library, args.library_stock))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()